@@ -1,3 +1,4 @@
+from pathlib import Path
 from typing import TypedDict
 
 STOP_WORDS: list[str] = ["デッキ", "サイドボード", "Deck", "Sideboard"]
@@ -7,6 +8,33 @@ TRANSLATE_CONDITION: str = r"《.*?/"
 ENGLISH_CONDITION: str = r"[a-zA-Z0-9_ ]{5}"
 NUMBER_CONDITION: str = r"[0-9]{,2}"
 
+# pdf 上のカード 1 枚の大きさ。
+CARD_WIDTH: int = 185
+CARD_HEIGHT: int = 257
+# この倍率以下の JPEG は縮小・再エンコードせずにそのまま pdf に埋め込む。
+# ReportLab は埋め込みの際に元の大きさでデコードするので、カードより大きい画像は縮小したほうが速く小さくなる。
+MAX_EMBED_SCALE: int = 1
+# 縮小した画像を pdf に埋め込むときの JPEG の品質。
+JPEG_QUALITY: int = 90
+
+# 1 秒あたりに行うカード検索の回数の上限。
+# magicthegathering.io は 1 時間あたりの上限しか公開していないので、Scryfall の目安 (10 回/秒) に合わせている。
+# Card.where(...).all() は結果のページ数だけ HTTP リクエストを送るので、これは HTTP リクエスト数ではなく検索の回数を制限する。
+API_CALLS_PER_SECOND: int = 10
+# 同時に API へ問い合わせるスレッド数。
+MAX_WORKERS: int = 8
+
+# Scryfall の一括データから作ったカード名と画像 URL の対応表を置く場所。
+CACHE_DIR: Path = Path("~/.cache/mtg_proxy").expanduser()
+BULK_DATA_URL: str = "https://api.scryfall.com/bulk-data/default-cards"
+# 対応表がこの秒数より古ければ、一括データが更新されていないか確認する。
+BULK_DATA_MAX_AGE: int = 7 * 24 * 60 * 60
+# Scryfall の言語コードと、このスクリプトで扱う言語名の対応。
+SCRYFALL_LANGUAGES: dict[str, str] = {"en": "English", "ja": "Japanese"}
+# アートカードやトークンなど、デッキに入れるカードではないものは対応表に入れない。
+SKIPPED_LAYOUTS: tuple[str, ...] = ("art_series", "token", "double_faced_token", "emblem")
+SKIPPED_SET_TYPES: tuple[str, ...] = ("memorabilia",)
+
 
 class CardBody(TypedDict, total=False):
     name: str
@@ -1,16 +1,93 @@
+import hashlib
+import json
+import os
 import re
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from pathlib import Path
 from typing import Optional
 from mtgsdk import Card
-from .commons import ENGLISH_CONDITION, STOP_WORDS, TRANSLATE_CONDITION, CardBody
+from .commons import (
+    API_CALLS_PER_SECOND,
+    BULK_DATA_MAX_AGE,
+    BULK_DATA_URL,
+    CACHE_DIR,
+    CARD_HEIGHT,
+    CARD_WIDTH,
+    ENGLISH_CONDITION,
+    JPEG_QUALITY,
+    MAX_EMBED_SCALE,
+    MAX_WORKERS,
+    SCRYFALL_LANGUAGES,
+    SKIPPED_LAYOUTS,
+    SKIPPED_SET_TYPES,
+    STOP_WORDS,
+    TRANSLATE_CONDITION,
+    CardBody,
+)
 from tqdm.auto import tqdm
-import urllib
 from PIL import Image
 import io
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from more_itertools import chunked
-from time import sleep
+from time import monotonic, sleep, time
 from reportlab.lib.colors import white
+from reportlab.lib.utils import ImageReader
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+
+class RateLimiter:
+    """
+    Limit the number of calls made within a sliding time window.
+
+    Parameters
+    ----------
+    max_calls : int
+        The maximum number of calls allowed within `period` seconds.
+    period : float
+        The length of the time window in seconds.
+    """
+
+    def __init__(self, max_calls: int, period: float = 1.0) -> None:
+        self.max_calls: int = max_calls
+        self.period: float = period
+        self._last_calls: deque[float] = deque()
+        self._lock: threading.Lock = threading.Lock()
+
+    def wait(self) -> None:
+        """
+        Block only as long as needed to stay within the rate limit.
+        """
+        with self._lock:
+            now: float = monotonic()
+            while self._last_calls and now - self._last_calls[0] >= self.period:
+                self._last_calls.popleft()
+            if len(self._last_calls) >= self.max_calls:
+                sleep_needed: float = max(0.0, self.period - (now - self._last_calls.popleft()))
+                sleep(sleep_needed)
+                now = monotonic()
+            self._last_calls.append(now)
+        return None
+
+
+_RATE_LIMITER: RateLimiter = RateLimiter(max_calls=API_CALLS_PER_SECOND)
+# 画像のダウンロードでは keep-alive の接続を使い回す。
+_SESSION: requests.Session = requests.Session()
+_SESSION.headers["User-Agent"] = "mtgproxy/0.1.0"
+_ADAPTER: HTTPAdapter = HTTPAdapter(
+    pool_connections=MAX_WORKERS,
+    pool_maxsize=MAX_WORKERS * 2,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504)),
+)
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+# Pillow 9.1 以降は Image.Resampling を使う。(それより前のバージョンでは Image の定数を使う。)
+_BILINEAR: int = getattr(Image, "Resampling", Image).BILINEAR
+_TRANSLATE_RE: re.Pattern = re.compile(TRANSLATE_CONDITION)
+_ENGLISH_RE: re.Pattern = re.compile(ENGLISH_CONDITION)
 
 
 def _read_txt(file_name: str) -> list[str]:
@@ -41,7 +118,7 @@ def _read_txt(file_name: str) -> list[str]:
     return texts
 
 
-def _search_card_name_by_language(language: str, card: Card) -> str:
+def _search_card_name_by_language(language: str, card: Card) -> Optional[str]:
     """
     Search for the card name registered in the API.
 
@@ -54,11 +131,10 @@ def _search_card_name_by_language(language: str, card: Card) -> str:
 
     Returns
     -------
-    str
-        The card name registered in the API.
+    Optional[str]
+        The card name registered in the API. If it does not exist, None is returned.
     """
-    language_card_info: dict[str, str] = [info for info in card.foreign_names if info["language"] == language][0]
-    return language_card_info["name"]
+    return next((info["name"] for info in card.foreign_names or [] if info["language"] == language), None)
 
 
 def _is_same_card_name(name: str, language: str, card: Card) -> bool:
@@ -81,7 +157,7 @@ def _is_same_card_name(name: str, language: str, card: Card) -> bool:
         False: Otherwise.
     """
     if language == "English":
-        card_name: str = card.name
+        card_name: Optional[str] = card.name
     else:
         card_name = _search_card_name_by_language(language=language, card=card)
 
@@ -91,6 +167,99 @@ def _is_same_card_name(name: str, language: str, card: Card) -> bool:
         return False
 
 
+def _download_card_index(download_uri: str) -> dict[str, dict[str, str]]:
+    """
+    Download the Scryfall bulk data and build the table of card names and image URLs.
+
+    Parameters
+    ----------
+    download_uri : str
+        The URL link of the bulk data.
+
+    Returns
+    -------
+    dict[str, dict[str, str]]
+        The URL links of card images keyed by language and card name.
+    """
+    card_index: dict[str, dict[str, str]] = {language: {} for language in SCRYFALL_LANGUAGES.values()}
+    with _SESSION.get(download_uri, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        # 一括データは 1 行に 1 枚のカードが書かれた JSON 配列なので、全体を読み込まずに 1 行ずつ処理する。
+        for line in tqdm(response.iter_lines(), unit="cards"):
+            line = line.strip().rstrip(b",")
+            if line in (b"", b"[", b"]"):
+                continue
+            card: dict = json.loads(line)
+            if card["lang"] not in SCRYFALL_LANGUAGES:
+                continue
+            # 同じ名前のアートカードや特大カードの画像が、通常のカードの画像より先に登録されないようにする。
+            if (
+                card.get("layout") in SKIPPED_LAYOUTS
+                or card.get("set_type") in SKIPPED_SET_TYPES
+                or card.get("oversized", False)
+            ):
+                continue
+            names: dict[str, str] = card_index[SCRYFALL_LANGUAGES[card["lang"]]]
+            # 両面カードは面ごとに画像を持っているので、それぞれの面の名前でも引けるようにする。
+            for face in [card] + card.get("card_faces", []):
+                image_url: Optional[str] = face.get("image_uris", card.get("image_uris", {})).get("normal")
+                name: Optional[str] = face.get("printed_name", face.get("name"))
+                if image_url is not None and name is not None:
+                    names.setdefault(name, image_url)
+    return card_index
+
+
+def _load_card_index() -> dict[str, dict[str, str]]:
+    """
+    Load the table of card names and image URLs, downloading it if it is missing or outdated.
+
+    Returns
+    -------
+    dict[str, dict[str, str]]
+        The URL links of card images keyed by language and card name.
+        If it cannot be prepared, an empty table is returned and every card is searched with the API.
+    """
+    index_path: Path = CACHE_DIR / "card_index.json"
+    cached: dict = {}
+    if index_path.exists():
+        try:
+            with open(index_path, "r") as f:
+                loaded: dict = json.load(f)
+            if not isinstance(loaded["cards"], dict):
+                raise TypeError("The cards in the card list must be a dict.")
+            cached = {"updated_at": loaded["updated_at"], "cards": loaded["cards"]}
+        except (ValueError, KeyError, TypeError, OSError):
+            tqdm.write("The saved card list is broken, so it will be downloaded again.")
+        else:
+            if time() - index_path.stat().st_mtime < BULK_DATA_MAX_AGE:
+                return cached["cards"]
+
+    try:
+        response: requests.Response = _SESSION.get(BULK_DATA_URL, headers={"Accept": "application/json"}, timeout=10)
+        response.raise_for_status()
+        bulk_data: dict = response.json()
+        if cached.get("updated_at") == bulk_data["updated_at"]:
+            index_path.touch()
+            return cached["cards"]
+
+        print("==== Download the card list from Scryfall. ====")
+        card_index: dict[str, dict[str, str]] = _download_card_index(download_uri=bulk_data["download_uri"])
+    except (requests.RequestException, ValueError, KeyError, TypeError, OSError):
+        tqdm.write("Could not update the card list from Scryfall.")
+        return cached.get("cards", {})
+
+    # 保存できなくても、今回の実行ではダウンロードした対応表をそのまま使う。
+    try:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path: Path = index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"updated_at": bulk_data["updated_at"], "cards": card_index}, f, ensure_ascii=False)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        tqdm.write(f"Could not save the card list to {index_path}.")
+    return card_index
+
+
 def _find_card_url_by_name(name: str, language: str) -> Optional[str]:
     """
     Search for URL link for the card image.
@@ -107,22 +276,54 @@ def _find_card_url_by_name(name: str, language: str) -> Optional[str]:
     Optional[str]
         The URL link of card image. If it does not exist, None is returned.
     """
-    sleep(1.0)
+    _RATE_LIMITER.wait()
     if language == "English":
         cards: list = Card.where(name=name).all()
     else:
         cards = Card.where(name=name).where(language=language).all()
 
-    checked_cards: list = [card for card in cards if _is_same_card_name(name=name, language=language, card=card)]
+    # 名前が一致し、かつ画像を持つ最初のカードを一度の走査で探す。
+    for card in cards:
+        if card.image_url is not None and _is_same_card_name(name=name, language=language, card=card):
+            return card.image_url
 
-    if len(checked_cards) == 0:
-        tqdm.write(f"Could not find image for {name}.")
-        return None
+    tqdm.write(f"Could not find image for {name}.")
+    return None
+
+
+def _parse_line(text: str) -> CardBody:
+    """
+    Read the card name, number of cards and search language from a line of the deck list.
+
+    Parameters
+    ----------
+    text : str
+        A line of the deck list.
+
+    Returns
+    -------
+    CardBody
+        The json where Card name, number of cards and search language are stored.
+    """
+    card_info: CardBody = {}
+    # 2桁入っている土地とかはそもそも無視している。
+    card_info["number"] = int(text[0])
+
+    # Wisdom Guildのデータかどうかの確認。
+    translate_match: Optional[re.Match] = _TRANSLATE_RE.search(text)
+    if translate_match is not None:
+        card_info["name"] = translate_match.group()
+        card_info["language"] = "Japanese"
     else:
-        for card in cards:
-            if card.image_url != None:
-                return card.image_url
-        return None
+        # MTG Arenaからインポートしたデッキで英語かどうかの確認。
+        if _ENGLISH_RE.match(text):
+            card_info["name"] = text[2:]
+            card_info["language"] = "English"
+        else:
+            words: list[str] = text.split(" ")
+            card_info["name"] = words[1]
+            card_info["language"] = "Japanese"
+    return card_info
 
 
 def _texts_data_to_jsons(texts: list[str]) -> list[CardBody]:
@@ -140,33 +341,30 @@ def _texts_data_to_jsons(texts: list[str]) -> list[CardBody]:
         the list of json where Card name, number of cards, search language and URL link are stored.
     """
     print("==== Get card information from text data. ====")
-    jsons: list[CardBody] = []
-    for text in tqdm(texts):
-        card_info: CardBody = {}
-        # 2桁入っている土地とかはそもそも無視している。
-        card_info["number"] = int(text[0])
-
-        # Wisdom Guildのデータかどうかの確認。
-        if re.search(TRANSLATE_CONDITION, text) is not None:
-            card_info["name"] = re.search(TRANSLATE_CONDITION, text).group()
-            card_info["language"] = "Japanese"
-        else:
-            # MTG Arenaからインポートしたデッキで英語かどうかの確認。
-            if re.match(ENGLISH_CONDITION, text):
-                card_info["name"] = text[2:]
-                card_info["language"] = "English"
-            else:
-                words: list[str] = text.split(" ")
-                card_info["name"] = words[1]
-                card_info["language"] = "Japanese"
-
-        image_url = _find_card_url_by_name(name=card_info["name"], language=card_info["language"])
-        if image_url is None:
-            card_info["image_url"] = ""
-        else:
-            card_info["image_url"] = image_url
-
-        jsons.append(card_info)
+    # 文字列の解析は軽いので先にまとめて済ませ、通信が必要な画像 URL の検索とは分けておく。
+    jsons: list[CardBody] = [_parse_line(text=text) for text in texts]
+
+    # 一括データにあるカードはまとめて引き、見つからなかったものだけ API に問い合わせる。
+    card_index: dict[str, dict[str, str]] = _load_card_index()
+    for card_info in jsons:
+        card_info["image_url"] = card_index.get(card_info["language"], {}).get(card_info["name"], "")
+    # メインとサイドボードの両方にあるカードなどは、一度だけ API に問い合わせる。
+    missing_jsons: dict[tuple[str, str], list[CardBody]] = {}
+    for card_info in jsons:
+        if card_info["image_url"] == "":
+            missing_jsons.setdefault((card_info["name"], card_info["language"]), []).append(card_info)
+
+    # API への問い合わせは通信待ちがほとんどなので、スレッドで並列に行う。
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures: dict[Future, tuple[str, str]] = {
+            executor.submit(_find_card_url_by_name, name=name, language=language): (name, language)
+            for name, language in missing_jsons
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            image_url: Optional[str] = future.result()
+            if image_url is not None:
+                for card_info in missing_jsons[futures[future]]:
+                    card_info["image_url"] = image_url
     print("===== The card information has been downloaded. =====")
     return jsons
 
@@ -185,19 +383,29 @@ def _normalize_image(image: Image.Image) -> Image.Image:
     Image.Image
         Card image arranged to a specific size.
     """
-    width: int = 185
-    height: int = 257
+    width: int = CARD_WIDTH
+    height: int = CARD_HEIGHT
+    # JPEG はデコード時に 1/2, 1/4, 1/8 に縮小できるので、カードの大きさを下回らない範囲で小さく読み込む。
+    image.draft("RGB", (width, height))
+    # 元の大きさの RGB 画像を作らないよう、RGB への変換は縮小の後に行う。
+    # ただしパレット画像などは reduce できないので先に変換する。
+    if image.mode not in ("L", "LA", "RGB", "RGBA", "CMYK"):
+        image = image.convert("RGB")
     image_width, image_height = image.size
-    width_reduction_rate: float = width / image_width
-    height_reduction_rate: float = height / image_height
-    image = image.convert("RGB")
-    image = image.resize((int(image_width * width_reduction_rate), int(image_height * height_reduction_rate)))
+    # 整数倍の縮小は軽いので、先に縮めてから端数分だけ resize する。
+    factor: int = min(image_width // width, image_height // height)
+    if factor > 1:
+        image = image.reduce(factor)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    # 印刷するカードの大きさでは BICUBIC と見分けがつかないので、より速い BILINEAR を使う。
+    image = image.resize((width, height), resample=_BILINEAR)
     return image
 
 
-def _url_to_jpeg(image_url: str) -> Image.Image:
+def _download_image(image_url: str) -> bytes:
     """
-    Convert URL to image.
+    Download the card image.
 
     Parameters
     ----------
@@ -206,16 +414,141 @@ def _url_to_jpeg(image_url: str) -> Image.Image:
 
     Returns
     -------
-    Image.Image
-        The Card image.
+    bytes
+        The encoded card image.
+    """
+    response: requests.Response = _SESSION.get(image_url, timeout=10)
+    response.raise_for_status()
+    return response.content
+
+
+def _bytes_to_jpeg(bytes_data: bytes) -> bytes:
+    """
+    Convert the downloaded data to the JPEG embedded in the pdf.
+
+    Parameters
+    ----------
+    bytes_data : bytes
+        The encoded card image.
+
+    Returns
+    -------
+    bytes
+        The Card image encoded in JPEG.
+        If it is a JPEG no larger than the card, the downloaded data is returned as it is so that it is embedded in the
+        pdf without being resized and re-encoded.
     """
-    bytes_data: bytes = urllib.request.urlopen(image_url).read()
     img: Image.Image = Image.open(io.BytesIO(bytes_data))
+    image_width, image_height = img.size
+    if (
+        img.format == "JPEG"
+        and img.mode == "RGB"
+        and image_width <= CARD_WIDTH * MAX_EMBED_SCALE
+        and image_height <= CARD_HEIGHT * MAX_EMBED_SCALE
+    ):
+        return bytes_data
     img = _normalize_image(image=img)
-    return img
+    # drawImage で埋め込めるよう、縮小後の画像を一度だけ JPEG にしておく。
+    jpeg_stream: io.BytesIO = io.BytesIO()
+    img.save(jpeg_stream, format="JPEG", quality=JPEG_QUALITY)
+    return jpeg_stream.getvalue()
 
 
-def _arrange_imgs(pdf: canvas.Canvas, imgs: list[Image.Image]) -> None:
+def _image_cache_path(image_url: str) -> Path:
+    """
+    Get the path where the converted card image is cached.
+
+    Parameters
+    ----------
+    image_url : str
+        The URL link of The card.
+
+    Returns
+    -------
+    Path
+        The path of the cached JPEG.
+    """
+    return CACHE_DIR / "images" / (hashlib.sha1(image_url.encode()).hexdigest() + ".jpg")
+
+
+def _convert_and_cache(image_url: str, bytes_data: bytes) -> bytes:
+    """
+    Convert the downloaded data to the JPEG embedded in the pdf and save it in the cache.
+
+    Parameters
+    ----------
+    image_url : str
+        The URL link of The card.
+    bytes_data : bytes
+        The encoded card image.
+
+    Returns
+    -------
+    bytes
+        The Card image encoded in JPEG.
+    """
+    jpeg_data: bytes = _bytes_to_jpeg(bytes_data=bytes_data)
+    # キャッシュは高速化のためだけのものなので、保存できなくても処理は続ける。
+    cache_path: Path = _image_cache_path(image_url=image_url)
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path: Path = cache_path.with_suffix(".tmp")
+        tmp_path.write_bytes(jpeg_data)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        tqdm.write(f"Could not save the card image to {cache_path}.")
+    return jpeg_data
+
+
+def _load_images(image_urls: list[str]) -> dict[str, ImageReader]:
+    """
+    Download the card images and convert them to images.
+
+    Parameters
+    ----------
+    image_urls : list[str]
+        The unique URL links of the cards.
+
+    Returns
+    -------
+    dict[str, ImageReader]
+        The card images keyed by their URL links.
+    """
+    # 一度変換した画像はディスクに保存してあるので、通信も変換もせずに読み込む。
+    jpeg_data: dict[str, bytes] = {}
+    for image_url in image_urls:
+        try:
+            jpeg_data[image_url] = _image_cache_path(image_url=image_url).read_bytes()
+        except OSError:
+            pass
+    missing_urls: list[str] = [image_url for image_url in image_urls if image_url not in jpeg_data]
+
+    # 通信はダウンロード用のスレッドで、画像の変換は CPU の数だけのスレッドで行う。
+    # PIL はデコードやリサイズ中に GIL を解放するので、変換もスレッドで並列に動く。
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as download_executor:
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as decode_executor:
+            download_futures: dict[Future, str] = {
+                download_executor.submit(_download_image, image_url=image_url): image_url for image_url in missing_urls
+            }
+            # ダウンロードが終わったものから順に変換に回し、通信と画像処理を重ねる。
+            # 変換した画像はその場で保存するので、途中でダウンロードに失敗しても次回は続きから始められる。
+            decode_futures: dict[Future, str] = {
+                decode_executor.submit(
+                    _convert_and_cache, image_url=download_futures[future], bytes_data=future.result()
+                ): download_futures[future]
+                for future in tqdm(as_completed(download_futures), total=len(download_futures))
+                if future.exception() is None
+            }
+            for future in as_completed(decode_futures):
+                jpeg_data[decode_futures[future]] = future.result()
+            # 成功した分を保存し終えてから、失敗したダウンロードのエラーを伝える。
+            for future in download_futures:
+                future.result()
+
+    return {image_url: ImageReader(io.BytesIO(bytes_data)) for image_url, bytes_data in jpeg_data.items()}
+
+
+def _arrange_imgs(pdf: canvas.Canvas, imgs: list[ImageReader]) -> None:
     """
     Arrange images neatly on pdf.
 
@@ -223,28 +556,20 @@ def _arrange_imgs(pdf: canvas.Canvas, imgs: list[Image.Image]) -> None:
     ----------
     pdf : canvas.Canvas
         The pdf that you want to print.
-    imgs : list[Image.Image]
+    imgs : list[ImageReader]
         List of images for proxy.
     """
     margin: int = 5
-    img_width: int = 185
-    img_height: int = 257
-    index: int = 0
-    for collum in range(3):
-        for row in range(3):
-            if index == len(imgs):
-                break
-            else:
-                pdf.drawInlineImage(
-                    imgs[index], img_width * row + margin * (row + 1), img_height * collum + margin * (collum + 1)
-                )
-                pdf.setFontSize(20)
-                pdf.setFillColor(white)
-                pdf.drawString(img_width * row + 30, img_height * collum + 150, "Proxy")
-                index += 1
-        else:
-            continue
-        break
+    img_width: int = CARD_WIDTH
+    img_height: int = CARD_HEIGHT
+    for index, img in enumerate(imgs[:9]):
+        row, collum = index % 3, index // 3
+        x: int = img_width * row + margin * (row + 1)
+        y: int = img_height * collum + margin * (collum + 1)
+        pdf.drawImage(img, x, y, width=img_width, height=img_height)
+        pdf.setFontSize(20)
+        pdf.setFillColor(white)
+        pdf.drawString(img_width * row + 30, img_height * collum + 150, "Proxy")
     return None
 
 
@@ -260,24 +585,31 @@ def _create_print_pdf(jsons: list[CardBody], save_name: str) -> None:
         The file name at the time of save.
     """
     print("===== Creates a proxy from card information. =====")
-    imgs: list[Image.Image] = []
-    for json in tqdm(jsons):
-        image_url: str = json["image_url"]
-        if image_url == "":
-            tqdm.write(f"{json['name']}は画像をダウンロードすることができませんでした。")
-        else:
-            imgs += [_url_to_jpeg(image_url=image_url) for _ in range(json["number"])]
+    for card_info in jsons:
+        if card_info["image_url"] == "":
+            tqdm.write(f"{card_info['name']}は画像をダウンロードすることができませんでした。")
+
+    # 同じカードの画像は一度だけダウンロード・デコードし、枚数分使い回す。
+    unique_urls: list[str] = list(
+        dict.fromkeys(card_info["image_url"] for card_info in jsons if card_info["image_url"])
+    )
+    url_to_img: dict[str, ImageReader] = _load_images(image_urls=unique_urls)
+    imgs: list[ImageReader] = [
+        url_to_img[card_info["image_url"]]
+        for card_info in jsons
+        if card_info["image_url"]
+        for _ in range(card_info["number"])
+    ]
 
     if save_name[-3:] != "pdf":
         save_name = save_name + ".pdf"
 
-    chunked_imgs: list[list[Image.Image]] = list(chunked(imgs, 9))
     pdf: canvas.Canvas = canvas.Canvas(save_name, pagesize=A4)
-    for i in range(len(chunked_imgs)):
+    for i, page_imgs in enumerate(chunked(imgs, 9)):
         if i != 0:
             pdf.showPage()
 
-        _arrange_imgs(pdf=pdf, imgs=chunked_imgs[i])
+        _arrange_imgs(pdf=pdf, imgs=page_imgs)
     pdf.save()
     print("===== Proxy data creation succeeded. =====")
     return None